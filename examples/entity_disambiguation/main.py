@@ -14,7 +14,7 @@ from wikipedia2vec.dump_db import DumpDB
 
 from luke.utils.entity_vocab import MASK_TOKEN, PAD_TOKEN
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForEntityDisambiguation
 from .utils import EntityDisambiguationDataset, convert_documents_to_features
@@ -254,7 +254,7 @@ def evaluate(args, eval_dataloader, model, entity_vocab, output_file=None):
         entity_attention_mask = inputs.pop("entity_attention_mask")
         input_entity_ids = entity_ids.new_full(entity_ids.size(), 1)  # [MASK]
         entity_length = entity_ids.size(1)
-        with torch.no_grad():
+        with inference_mode():
             if args.use_context_entities:
                 result = torch.zeros(entity_length, dtype=torch.long)
                 prediction_order = torch.zeros(entity_length, dtype=torch.long)
@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
-from luke.model import BertLayerNorm, LukeModel
+from luke.model import LukeModel
 from luke.pretraining.model import EntityPredictionHead
 
 
@@ -12,11 +12,11 @@ class EntityEmbeddings(nn.Module):
         self.config = config
 
         self.entity_embeddings = nn.Embedding(config.entity_vocab_size, config.hidden_size, padding_idx=0)
-        self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
+        self.position_embeddings = nn.EmbeddingBag(config.max_position_embeddings, config.hidden_size, mode="sum")
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
         self.mask_embedding = nn.Parameter(torch.zeros(1, config.hidden_size))
 
-        self.LayerNorm = BertLayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+        self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, entity_ids, position_ids, token_type_ids):
@@ -25,15 +25,20 @@ class EntityEmbeddings(nn.Module):
             (entity_ids == 1).unsqueeze(-1), self.mask_embedding.expand_as(entity_embeddings)
         )
 
-        position_embeddings = self.position_embeddings(position_ids.clamp(min=0))
-        position_embedding_mask = (position_ids != -1).type_as(position_embeddings).unsqueeze(-1)
-        position_embeddings = position_embeddings * position_embedding_mask
-        position_embeddings = torch.sum(position_embeddings, dim=-2)
-        position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-2).clamp(min=1e-7)
+        # the masked sum of the position embeddings is computed by EmbeddingBag without materializing the embeddings
+        # of all (mostly padded) positions
+        position_embedding_mask = (position_ids != -1).type_as(self.position_embeddings.weight)
+        position_embeddings = self.position_embeddings(
+            position_ids.clamp(min=0).reshape(-1, position_ids.size(-1)),
+            per_sample_weights=position_embedding_mask.reshape(-1, position_ids.size(-1)),
+        )
+        position_embeddings = position_embeddings.view(*position_ids.size()[:-1], self.config.hidden_size)
+        position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-1, keepdim=True).clamp(min=1e-7)
 
         token_type_embeddings = self.token_type_embeddings(token_type_ids)
 
-        embeddings = entity_embeddings + position_embeddings + token_type_embeddings
+        # the embeddings are summed in place into the freshly allocated position embeddings
+        embeddings = position_embeddings.add_(entity_embeddings).add_(token_type_embeddings)
         embeddings = self.LayerNorm(embeddings)
         embeddings = self.dropout(embeddings)
 
@@ -13,7 +13,7 @@ from transformers import WEIGHTS_NAME
 
 from luke.utils.entity_vocab import MASK_TOKEN
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForEntitySpanQA
 from .record_eval import evaluate as evaluate_on_record
@@ -137,10 +137,10 @@ def run(common_args, **task_args):
 def evaluate(args, model, fold="dev", output_file=None):
     dataloader, examples, features, processor = load_and_cache_examples(args, fold)
     doc_predictions = defaultdict(list)
+    model.eval()
     for batch in tqdm(dataloader, desc="Eval"):
-        model.eval()
         inputs = {k: v.to(args.device) for k, v in batch.items() if k != "feature_indices"}
-        with torch.no_grad():
+        with inference_mode():
             logits = model(**inputs)
 
         for i, feature_index in enumerate(batch["feature_indices"]):
@@ -11,7 +11,7 @@ from tqdm import tqdm
 from transformers import WEIGHTS_NAME
 from luke.utils.entity_vocab import MASK_TOKEN
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForEntityTyping
 from .utils import ENTITY_TOKEN, convert_examples_to_features, DatasetProcessor
@@ -127,7 +127,7 @@ def evaluate(args, model, fold="dev", output_file=None):
     all_labels = []
     for batch in tqdm(dataloader, desc=fold):
         inputs = {k: v.to(args.device) for k, v in batch.items() if k != "labels"}
-        with torch.no_grad():
+        with inference_mode():
             logits = model(**inputs)
 
         logits = logits.detach().cpu().tolist()
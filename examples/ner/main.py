@@ -14,7 +14,7 @@ from transformers import WEIGHTS_NAME
 
 from luke.utils.entity_vocab import MASK_TOKEN
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForNamedEntityRecognition
 from .utils import CoNLLProcessor, convert_examples_to_features
@@ -103,10 +103,10 @@ def evaluate(args, model, fold, output_file=None):
     label_list = processor.get_labels()
     all_predictions = defaultdict(dict)
 
+    model.eval()
     for batch in tqdm(dataloader, desc="Eval"):
-        model.eval()
         inputs = {k: v.to(args.device) for k, v in batch.items() if k != "feature_indices"}
-        with torch.no_grad():
+        with inference_mode():
             logits = model(**inputs)
 
         for i, feature_index in enumerate(batch["feature_indices"]):
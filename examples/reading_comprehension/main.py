@@ -14,7 +14,7 @@ from tqdm import tqdm
 from transformers import WEIGHTS_NAME, BertTokenizer
 from wikipedia2vec.dump_db import DumpDB
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.mention_db import MentionDB
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForReadingComprehension
@@ -143,20 +143,33 @@ def run(common_args, **task_args):
     return results
 
 
+def _get_best_indexes(logits, n_best_size):
+    # a stable sort is used so that ties are broken by the lower index, as torch.topk does not define their order
+    try:
+        return logits.sort(dim=1, descending=True, stable=True)[1][:, :n_best_size].cpu().tolist()
+    except TypeError:
+        # the stable option of torch.sort is not available before PyTorch 1.9
+        return [
+            sorted(range(len(row)), key=row.__getitem__, reverse=True)[:n_best_size] for row in logits.cpu().tolist()
+        ]
+
+
 def evaluate(args, model, prefix=""):
     dataloader, examples, features, processor = load_and_cache_examples(args, evaluate=True)
     all_results = []
+    model.eval()
     for batch in tqdm(dataloader, desc="eval"):
-        model.eval()
         inputs = {k: v.to(args.device) for k, v in batch.items() if k != "example_indices"}
-        with torch.no_grad():
+        with inference_mode():
             outputs = model(**inputs)
 
+        # the n-best indexes are selected on the device and the logits are transferred once per batch
+        start_indexes, end_indexes = [_get_best_indexes(o, args.n_best_size) for o in outputs]
+        start_logits, end_logits = [o.cpu().tolist() for o in outputs]
         for i, example_index in enumerate(batch["example_indices"]):
             eval_feature = features[example_index.item()]
             unique_id = int(eval_feature.unique_id)
-            start_logits, end_logits = [o[i].detach().cpu().tolist() for o in outputs]
-            all_results.append(Result(unique_id, start_logits, end_logits))
+            all_results.append(Result(unique_id, start_logits[i], end_logits[i], start_indexes[i], end_indexes[i]))
 
     output_prediction_file = os.path.join(args.output_dir, "predictions_{}.json".format(prefix))
     output_nbest_file = os.path.join(args.output_dir, "nbest_predictions_{}.json".format(prefix))
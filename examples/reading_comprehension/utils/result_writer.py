@@ -10,10 +10,12 @@ logger = logging.getLogger(__name__)
 
 
 class Result(object):
-    def __init__(self, unique_id, start_logits, end_logits):
+    def __init__(self, unique_id, start_logits, end_logits, start_indexes, end_indexes):
         self.unique_id = unique_id
         self.start_logits = start_logits
         self.end_logits = end_logits
+        self.start_indexes = start_indexes
+        self.end_indexes = end_indexes
 
 
 def write_predictions(
@@ -61,8 +63,8 @@ def write_predictions(
         null_end_logit = 0  # the end logit at the slice with min null score
         for (feature_index, feature) in enumerate(features):
             result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+            start_indexes = result.start_indexes
+            end_indexes = result.end_indexes
             # if we could have irrelevant answers, get the min score of irrelevant
             if version_2_with_negative:
                 feature_null_score = result.start_logits[0] + result.end_logits[0]
@@ -275,17 +277,6 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     return orig_text[orig_start_position : (orig_end_position + 1)]
 
 
-def _get_best_indexes(logits, n_best_size):
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
-
-
 def _compute_softmax(scores):
     if not scores:
         return []
@@ -12,7 +12,7 @@ from transformers import WEIGHTS_NAME
 
 from luke.utils.entity_vocab import MASK_TOKEN
 
-from ..utils import set_seed
+from ..utils import inference_mode, set_seed
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForRelationClassification
 from .utils import HEAD_TOKEN, TAIL_TOKEN, convert_examples_to_features, DatasetProcessor
@@ -128,7 +128,7 @@ def evaluate(args, model, fold="dev", output_file=None):
     model.eval()
     for batch in tqdm(dataloader, desc=fold):
         inputs = {k: v.to(args.device) for k, v in batch.items() if k != "label"}
-        with torch.no_grad():
+        with inference_mode():
             logits = model(**inputs)
 
         predictions.extend(logits.detach().cpu().numpy().argmax(axis=1))
@@ -11,6 +11,14 @@ def set_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def inference_mode():
+    # inference mode additionally disables view tracking and version counter bumps, but is only available in recent
+    # PyTorch releases
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 def is_whitespace(c):
     if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
         return True
@@ -1,3 +1,5 @@
+import contextlib
+import inspect
 import logging
 import math
 from typing import Dict
@@ -5,12 +7,13 @@ from typing import Dict
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_bert import (
+    ACT2FN,
     BertConfig,
     BertEmbeddings,
     BertEncoder,
     BertIntermediate,
-    BertLayerNorm,
     BertOutput,
     BertPooler,
     BertSelfOutput,
@@ -19,6 +22,55 @@ from transformers.modeling_roberta import RobertaEmbeddings
 
 logger = logging.getLogger(__name__)
 
+# the non-reentrant implementation of checkpoint supports torch.autograd.grad and inputs that do not require gradients,
+# but is only available in PyTorch 1.11 or later; the reentrant implementation is used with earlier versions
+if "use_reentrant" in inspect.signature(checkpoint).parameters:
+    _CHECKPOINT_KWARGS = dict(use_reentrant=False)
+else:
+    _CHECKPOINT_KWARGS = {}
+
+
+def get_activation_fn(hidden_act):
+    if not isinstance(hidden_act, str):
+        return hidden_act
+    if hidden_act == "gelu":
+        # the erf-based GELU computed by a single fused kernel instead of a chain of elementwise operations
+        return F.gelu
+    return ACT2FN[hidden_act]
+
+
+def checkpoint_layers(layers: nn.ModuleList, layer_fn, *hidden_states):
+    # the layers are run in segments of ceil(sqrt(L)) layers and only the inputs of each segment are kept during the
+    # forward pass, which reduces the activation memory to O(sqrt(L)) at the cost of recomputing the segments in the
+    # backward pass
+    segment_size = int(math.ceil(math.sqrt(len(layers))))
+    for start in range(0, len(layers), segment_size):
+
+        def run_segment(*hidden_states, segment=layers[start : start + segment_size]):
+            for layer_module in segment:
+                hidden_states = layer_fn(layer_module, *hidden_states)
+            return hidden_states
+
+        hidden_states = checkpoint(run_segment, *hidden_states, **_CHECKPOINT_KWARGS)
+    return hidden_states
+
+
+# the side streams are cached per device at the module level instead of in the models so that the models can still be
+# copied and pickled
+_side_streams = {}
+
+
+def get_side_stream(device: torch.device) -> torch.cuda.Stream:
+    if device not in _side_streams:
+        _side_streams[device] = torch.cuda.Stream(device)
+    return _side_streams[device]
+
+
+def apply_linear_2d(linear: nn.Linear, x: torch.Tensor):
+    # the input is flattened to a contiguous 2D tensor so that the projection and the bias addition run as a single
+    # fused GEMM (addmm) even if the input is a non-contiguous slice
+    return linear(x.reshape(-1, x.size(-1))).view(*x.size()[:-1], linear.out_features)
+
 
 class LukeConfig(BertConfig):
     def __init__(
@@ -43,31 +95,38 @@ class EntityEmbeddings(nn.Module):
         if config.entity_emb_size != config.hidden_size:
             self.entity_embedding_dense = nn.Linear(config.entity_emb_size, config.hidden_size, bias=False)
 
-        self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
+        self.position_embeddings = nn.EmbeddingBag(config.max_position_embeddings, config.hidden_size, mode="sum")
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
 
-        self.LayerNorm = BertLayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+        self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(
         self, entity_ids: torch.LongTensor, position_ids: torch.LongTensor, token_type_ids: torch.LongTensor = None
     ):
-        if token_type_ids is None:
-            token_type_ids = torch.zeros_like(entity_ids)
-
         entity_embeddings = self.entity_embeddings(entity_ids)
         if self.config.entity_emb_size != self.config.hidden_size:
             entity_embeddings = self.entity_embedding_dense(entity_embeddings)
 
-        position_embeddings = self.position_embeddings(position_ids.clamp(min=0))
-        position_embedding_mask = (position_ids != -1).type_as(position_embeddings).unsqueeze(-1)
-        position_embeddings = position_embeddings * position_embedding_mask
-        position_embeddings = torch.sum(position_embeddings, dim=-2)
-        position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-2).clamp(min=1e-7)
+        # the masked sum of the position embeddings is computed by EmbeddingBag without materializing the embeddings
+        # of all (mostly padded) positions
+        position_embedding_mask = (position_ids != -1).type_as(self.position_embeddings.weight)
+        position_embeddings = self.position_embeddings(
+            position_ids.clamp(min=0).reshape(-1, position_ids.size(-1)),
+            per_sample_weights=position_embedding_mask.reshape(-1, position_ids.size(-1)),
+        )
+        position_embeddings = position_embeddings.view(*position_ids.size()[:-1], self.config.hidden_size)
+        position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-1, keepdim=True).clamp(min=1e-7)
 
-        token_type_embeddings = self.token_type_embeddings(token_type_ids)
+        if token_type_ids is None:
+            # all tokens have the token type 0, so the lookup is replaced by broadcasting its embedding
+            token_type_embeddings = self.token_type_embeddings.weight[0]
+        else:
+            token_type_embeddings = self.token_type_embeddings(token_type_ids)
 
-        embeddings = entity_embeddings + position_embeddings + token_type_embeddings
+        # the embeddings are summed in place into the freshly allocated position embeddings, which keep the
+        # parameter dtype even if the entity embeddings are computed in lower precision under autocast
+        embeddings = position_embeddings.add_(entity_embeddings).add_(token_type_embeddings)
         embeddings = self.LayerNorm(embeddings)
         embeddings = self.dropout(embeddings)
 
@@ -75,12 +134,14 @@ class EntityEmbeddings(nn.Module):
 
 
 class LukeModel(nn.Module):
-    def __init__(self, config: LukeConfig):
+    def __init__(self, config: LukeConfig, use_amp: bool = False, amp_dtype: torch.dtype = torch.bfloat16):
         super(LukeModel, self).__init__()
 
         self.config = config
+        self.use_amp = use_amp
+        self.amp_dtype = amp_dtype
 
-        self.encoder = BertEncoder(config)
+        self.encoder = self._create_encoder(config)
         self.pooler = BertPooler(config)
 
         if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
@@ -100,35 +161,102 @@ class LukeModel(nn.Module):
         entity_segment_ids: torch.LongTensor = None,
         entity_attention_mask: torch.LongTensor = None,
     ):
-        word_seq_size = word_ids.size(1)
-
-        embedding_output = self.embeddings(word_ids, word_segment_ids)
+        with self._autocast(word_ids.device.type):
+            word_seq_size = word_ids.size(1)
 
-        attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
-        if entity_ids is not None:
-            entity_embedding_output = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
-            embedding_output = torch.cat([embedding_output, entity_embedding_output], dim=1)
+            embedding_output, entity_embedding_output = self._compute_embeddings(
+                word_ids, word_segment_ids, entity_ids, entity_position_ids, entity_segment_ids
+            )
 
-        encoder_outputs = self.encoder(embedding_output, attention_mask, [None] * self.config.num_hidden_layers)
-        sequence_output = encoder_outputs[0]
-        word_sequence_output = sequence_output[:, :word_seq_size, :]
-        pooled_output = self.pooler(sequence_output)
+            attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
+            if entity_ids is not None:
+                embedding_output = torch.cat([embedding_output, entity_embedding_output], dim=1)
+
+            if getattr(self.encoder, "gradient_checkpointing", False) and self.training:
+                # the checkpointed layers only return the hidden states
+                if self.config.output_hidden_states or self.config.output_attentions:
+                    raise ValueError(
+                        "gradient checkpointing cannot be used with output_hidden_states or output_attentions"
+                    )
+                encoder_outputs = checkpoint_layers(
+                    self.encoder.layer, lambda layer_module, h: layer_module(h, attention_mask)[:1], embedding_output
+                )
+            else:
+                encoder_outputs = self.encoder(embedding_output, attention_mask, [None] * self.config.num_hidden_layers)
+            sequence_output = encoder_outputs[0]
+            word_sequence_output = sequence_output[:, :word_seq_size, :]
+            pooled_output = self.pooler(sequence_output)
+
+            if entity_ids is not None:
+                entity_sequence_output = sequence_output[:, word_seq_size:, :]
+                return (word_sequence_output, entity_sequence_output, pooled_output,) + encoder_outputs[1:]
+            else:
+                return (word_sequence_output, pooled_output,) + encoder_outputs[1:]
 
-        if entity_ids is not None:
-            entity_sequence_output = sequence_output[:, word_seq_size:, :]
-            return (word_sequence_output, entity_sequence_output, pooled_output,) + encoder_outputs[1:]
-        else:
-            return (word_sequence_output, pooled_output,) + encoder_outputs[1:]
+    def _compute_embeddings(
+        self,
+        word_ids: torch.LongTensor,
+        word_segment_ids: torch.LongTensor,
+        entity_ids: torch.LongTensor,
+        entity_position_ids: torch.LongTensor,
+        entity_segment_ids: torch.LongTensor,
+    ):
+        if entity_ids is None:
+            return self.embeddings(word_ids, word_segment_ids), None
+
+        if not word_ids.is_cuda:
+            word_embeddings = self.embeddings(word_ids, word_segment_ids)
+            entity_embeddings = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
+            return word_embeddings, entity_embeddings
+
+        # the word and entity embeddings are independent, so the entity embeddings are computed on a side stream to
+        # overlap with the word embeddings computed on the current stream
+        current_stream = torch.cuda.current_stream(word_ids.device)
+        side_stream = get_side_stream(word_ids.device)
+
+        side_stream.wait_stream(current_stream)
+        with torch.cuda.stream(side_stream):
+            entity_embeddings = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
+        word_embeddings = self.embeddings(word_ids, word_segment_ids)
+        current_stream.wait_stream(side_stream)
+        # prevents the caching allocator from reusing the memory on the side stream while the current stream uses it
+        entity_embeddings.record_stream(current_stream)
+
+        return word_embeddings, entity_embeddings
+
+    def _create_encoder(self, config: LukeConfig) -> nn.Module:
+        encoder = BertEncoder(config)
+        for layer in encoder.layer:
+            layer.intermediate.intermediate_act_fn = get_activation_fn(config.hidden_act)
+        return encoder
+
+    @property
+    def dtype(self) -> torch.dtype:
+        # looking up a single parameter avoids iterating over all parameters and always reflects the current dtype
+        # of the model, including when the parameters are cast in place (e.g., by apex)
+        return self.embeddings.word_embeddings.weight.dtype
+
+    def gradient_checkpointing_enable(self):
+        self.encoder.gradient_checkpointing = True
+
+    def compile_layers(self, mode: str = "reduce-overhead", fullgraph: bool = True):
+        # each layer is compiled in place so that the parameter names in the state dict are unchanged; the layers
+        # are compiled instead of the whole model because their input shapes are stable, and the inputs should be
+        # padded to fixed lengths to avoid recompilation
+        if not hasattr(nn.Module, "compile"):
+            raise RuntimeError("compile_layers requires PyTorch 2.2 or later")
+        for layer_module in self.encoder.layer:
+            layer_module.compile(mode=mode, fullgraph=fullgraph)
 
     def init_weights(self, module: nn.Module):
         if isinstance(module, nn.Linear):
             module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
-        elif isinstance(module, nn.Embedding):
+        elif isinstance(module, (nn.Embedding, nn.EmbeddingBag)):
             if module.embedding_dim == 1:  # embedding for bias parameters
                 module.weight.data.zero_()
             else:
                 module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
-        elif isinstance(module, BertLayerNorm):
+        elif isinstance(module, nn.LayerNorm):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
         if isinstance(module, nn.Linear) and module.bias is not None:
@@ -183,18 +311,25 @@ class LukeModel(nn.Module):
         attention_mask = word_attention_mask
         if entity_attention_mask is not None:
             attention_mask = torch.cat([attention_mask, entity_attention_mask], dim=1)
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        attention_mask = attention_mask[:, None, None, :]
+        dtype = self.dtype
+        extended_attention_mask = (attention_mask == 0).to(dtype=dtype) * torch.finfo(dtype).min
 
         return extended_attention_mask
 
+    def _autocast(self, device_type: str):
+        if not self.use_amp:
+            return contextlib.ExitStack()
+        return torch.autocast(device_type=device_type, dtype=self.amp_dtype)
+
 
 class LukeEntityAwareAttentionModel(LukeModel):
-    def __init__(self, config):
-        super(LukeEntityAwareAttentionModel, self).__init__(config)
+    def __init__(self, config: LukeConfig, use_amp: bool = False, amp_dtype: torch.dtype = torch.bfloat16):
+        super(LukeEntityAwareAttentionModel, self).__init__(config, use_amp=use_amp, amp_dtype=amp_dtype)
         self.config = config
-        self.encoder = EntityAwareEncoder(config)
+
+    def _create_encoder(self, config: LukeConfig) -> nn.Module:
+        return EntityAwareEncoder(config)
 
     def forward(
         self,
@@ -206,29 +341,39 @@ class LukeEntityAwareAttentionModel(LukeModel):
         entity_segment_ids,
         entity_attention_mask,
     ):
-        word_embeddings = self.embeddings(word_ids, word_segment_ids)
-        entity_embeddings = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
-        attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
+        with self._autocast(word_ids.device.type):
+            word_embeddings, entity_embeddings = self._compute_embeddings(
+                word_ids, word_segment_ids, entity_ids, entity_position_ids, entity_segment_ids
+            )
+            attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
 
-        return self.encoder(word_embeddings, entity_embeddings, attention_mask)
+            return self.encoder(word_embeddings, entity_embeddings, attention_mask)
 
     def load_state_dict(self, state_dict, *args, **kwargs):
         new_state_dict = state_dict.copy()
 
         for num in range(self.config.num_hidden_layers):
+            prefix = f"encoder.layer.{num}.attention.self."
             for attr_name in ("weight", "bias"):
-                if f"encoder.layer.{num}.attention.self.w2e_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.w2e_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
-                if f"encoder.layer.{num}.attention.self.e2w_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.e2w_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
-                if f"encoder.layer.{num}.attention.self.e2e_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.e2e_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
+                if f"{prefix}key_value.{attr_name}" not in state_dict:
+                    new_state_dict[f"{prefix}key_value.{attr_name}"] = torch.cat(
+                        [state_dict[f"{prefix}key.{attr_name}"], state_dict[f"{prefix}value.{attr_name}"]]
+                    )
+                if f"{prefix}word_query.{attr_name}" not in state_dict:
+                    query = state_dict[f"{prefix}query.{attr_name}"]
+                    new_state_dict[f"{prefix}word_query.{attr_name}"] = torch.cat(
+                        [query, state_dict.get(f"{prefix}w2e_query.{attr_name}", query)]
+                    )
+                if f"{prefix}entity_query.{attr_name}" not in state_dict:
+                    query = state_dict[f"{prefix}query.{attr_name}"]
+                    new_state_dict[f"{prefix}entity_query.{attr_name}"] = torch.cat(
+                        [
+                            state_dict.get(f"{prefix}e2w_query.{attr_name}", query),
+                            state_dict.get(f"{prefix}e2e_query.{attr_name}", query),
+                        ]
+                    )
+                for name in ("query", "key", "value", "w2e_query", "e2w_query", "e2e_query"):
+                    new_state_dict.pop(f"{prefix}{name}.{attr_name}", None)
 
         kwargs["strict"] = False
         super(LukeEntityAwareAttentionModel, self).load_state_dict(new_state_dict, *args, **kwargs)
@@ -242,60 +387,93 @@ class EntityAwareSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.key = nn.Linear(config.hidden_size, self.all_head_size)
-        self.value = nn.Linear(config.hidden_size, self.all_head_size)
-
-        self.w2e_query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.e2w_query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.e2e_query = nn.Linear(config.hidden_size, self.all_head_size)
+        # projections sharing the same input are fused into a single linear layer: word_query holds the
+        # word-to-word and word-to-entity queries, entity_query holds the entity-to-word and entity-to-entity
+        # queries, and key_value holds the keys and values
+        self.word_query = nn.Linear(config.hidden_size, 2 * self.all_head_size)
+        self.entity_query = nn.Linear(config.hidden_size, 2 * self.all_head_size)
+        self.key_value = nn.Linear(config.hidden_size, 2 * self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        self.max_chunk_size_mb = 512
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         return x.view(*new_x_shape).permute(0, 2, 1, 3)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_size = word_hidden_states.size(1)
-
-        w2w_query_layer = self.transpose_for_scores(self.query(word_hidden_states))
-        w2e_query_layer = self.transpose_for_scores(self.w2e_query(word_hidden_states))
-        e2w_query_layer = self.transpose_for_scores(self.e2w_query(entity_hidden_states))
-        e2e_query_layer = self.transpose_for_scores(self.e2e_query(entity_hidden_states))
-
-        key_layer = self.transpose_for_scores(self.key(torch.cat([word_hidden_states, entity_hidden_states], dim=1)))
-
-        w2w_key_layer = key_layer[:, :, :word_size, :]
-        e2w_key_layer = key_layer[:, :, :word_size, :]
-        w2e_key_layer = key_layer[:, :, word_size:, :]
-        e2e_key_layer = key_layer[:, :, word_size:, :]
-
-        w2w_attention_scores = torch.matmul(w2w_query_layer, w2w_key_layer.transpose(-1, -2))
-        w2e_attention_scores = torch.matmul(w2e_query_layer, w2e_key_layer.transpose(-1, -2))
-        e2w_attention_scores = torch.matmul(e2w_query_layer, e2w_key_layer.transpose(-1, -2))
-        e2e_attention_scores = torch.matmul(e2e_query_layer, e2e_key_layer.transpose(-1, -2))
-
-        word_attention_scores = torch.cat([w2w_attention_scores, w2e_attention_scores], dim=3)
-        entity_attention_scores = torch.cat([e2w_attention_scores, e2e_attention_scores], dim=3)
-        attention_scores = torch.cat([word_attention_scores, entity_attention_scores], dim=2)
-
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        attention_scores = attention_scores + attention_mask
-
-        attention_probs = F.softmax(attention_scores, dim=-1)
-        attention_probs = self.dropout(attention_probs)
-
-        value_layer = self.transpose_for_scores(
-            self.value(torch.cat([word_hidden_states, entity_hidden_states], dim=1))
-        )
-        context_layer = torch.matmul(attention_probs, value_layer)
-
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
-
-        return context_layer[:, :word_size, :], context_layer[:, word_size:, :]
+    def forward(self, hidden_states, attention_mask, word_size):
+        word_hidden_states = hidden_states[:, :word_size, :]
+        entity_hidden_states = hidden_states[:, word_size:, :]
+
+        w2w_query_layer, w2e_query_layer = [
+            self.transpose_for_scores(x)
+            for x in apply_linear_2d(self.word_query, word_hidden_states).chunk(2, dim=-1)
+        ]
+        e2w_query_layer, e2e_query_layer = [
+            self.transpose_for_scores(x)
+            for x in apply_linear_2d(self.entity_query, entity_hidden_states).chunk(2, dim=-1)
+        ]
+
+        key_value = apply_linear_2d(self.key_value, hidden_states)
+        key_layer, value_layer = [self.transpose_for_scores(x) for x in key_value.chunk(2, dim=-1)]
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            # the four query-key blocks are computed in a single fused attention call by concatenating the two
+            # queries of each token along the head dimension and zero-padding the word and entity keys so that each
+            # query half only attends to its own block; the queries are rescaled to keep the original 1/sqrt(d)
+            word_query_layer = torch.cat([w2w_query_layer, w2e_query_layer], dim=-1)
+            entity_query_layer = torch.cat([e2w_query_layer, e2e_query_layer], dim=-1)
+            query_layer = torch.cat([word_query_layer, entity_query_layer], dim=2) * math.sqrt(2.0)
+            key_layer = torch.cat(
+                [
+                    F.pad(key_layer[:, :, :word_size, :], (0, self.attention_head_size)),
+                    F.pad(key_layer[:, :, word_size:, :], (self.attention_head_size, 0)),
+                ],
+                dim=2,
+            )
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask.to(dtype=query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            # the attention is computed over chunks of query rows so that the attention score tensor of each chunk
+            # does not exceed max_chunk_size_mb
+            word_key_layer = key_layer[:, :, :word_size, :]
+            entity_key_layer = key_layer[:, :, word_size:, :]
+            # the scores are promoted to the dtype of the attention mask when it is added (e.g., from bfloat16 to
+            # float32 under autocast), so the larger of the two element sizes is materialized
+            element_size = max(key_layer.element_size(), attention_mask.element_size())
+            row_size = key_layer.size(0) * key_layer.size(1) * key_layer.size(2) * element_size
+            chunk_size = max(1, self.max_chunk_size_mb * 1024 * 1024 // row_size)
+
+            context_layers = []
+            for to_word_query_layer, to_entity_query_layer in (
+                (w2w_query_layer, w2e_query_layer),
+                (e2w_query_layer, e2e_query_layer),
+            ):
+                for start in range(0, to_word_query_layer.size(2), chunk_size):
+                    to_word_attention_scores = torch.matmul(
+                        to_word_query_layer[:, :, start : start + chunk_size], word_key_layer.transpose(-1, -2)
+                    )
+                    to_entity_attention_scores = torch.matmul(
+                        to_entity_query_layer[:, :, start : start + chunk_size], entity_key_layer.transpose(-1, -2)
+                    )
+                    attention_scores = torch.cat([to_word_attention_scores, to_entity_attention_scores], dim=3)
+
+                    attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+                    attention_scores = attention_scores + attention_mask
+
+                    attention_probs = F.softmax(attention_scores, dim=-1)
+                    attention_probs = self.dropout(attention_probs)
+
+                    context_layers.append(torch.matmul(attention_probs, value_layer))
+
+            context_layer = torch.cat(context_layers, dim=2)
+
+        return context_layer.transpose(1, 2).reshape(hidden_states.size()[:-1] + (self.all_head_size,))
 
 
 class EntityAwareAttention(nn.Module):
@@ -304,12 +482,9 @@ class EntityAwareAttention(nn.Module):
         self.self = EntityAwareSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_self_output, entity_self_output = self.self(word_hidden_states, entity_hidden_states, attention_mask)
-        hidden_states = torch.cat([word_hidden_states, entity_hidden_states], dim=1)
-        self_output = torch.cat([word_self_output, entity_self_output], dim=1)
-        output = self.output(self_output, hidden_states)
-        return output[:, : word_hidden_states.size(1), :], output[:, word_hidden_states.size(1) :, :]
+    def forward(self, hidden_states, attention_mask, word_size):
+        self_output = self.self(hidden_states, attention_mask, word_size)
+        return self.output(self_output, hidden_states)
 
 
 class EntityAwareLayer(nn.Module):
@@ -318,27 +493,32 @@ class EntityAwareLayer(nn.Module):
 
         self.attention = EntityAwareAttention(config)
         self.intermediate = BertIntermediate(config)
+        self.intermediate.intermediate_act_fn = get_activation_fn(config.hidden_act)
         self.output = BertOutput(config)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_attention_output, entity_attention_output = self.attention(
-            word_hidden_states, entity_hidden_states, attention_mask
-        )
-        attention_output = torch.cat([word_attention_output, entity_attention_output], dim=1)
+    def forward(self, hidden_states, attention_mask, word_size):
+        attention_output = self.attention(hidden_states, attention_mask, word_size)
         intermediate_output = self.intermediate(attention_output)
-        layer_output = self.output(intermediate_output, attention_output)
-
-        return layer_output[:, : word_hidden_states.size(1), :], layer_output[:, word_hidden_states.size(1) :, :]
+        return self.output(intermediate_output, attention_output)
 
 
 class EntityAwareEncoder(nn.Module):
     def __init__(self, config):
         super(EntityAwareEncoder, self).__init__()
         self.layer = nn.ModuleList([EntityAwareLayer(config) for _ in range(config.num_hidden_layers)])
+        self.gradient_checkpointing = False
 
     def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        for layer_module in self.layer:
-            word_hidden_states, entity_hidden_states = layer_module(
-                word_hidden_states, entity_hidden_states, attention_mask
+        # the word and entity sequences are processed jointly by all layers and only split at the end
+        word_size = word_hidden_states.size(1)
+        hidden_states = torch.cat([word_hidden_states, entity_hidden_states], dim=1)
+
+        if self.gradient_checkpointing and self.training:
+            (hidden_states,) = checkpoint_layers(
+                self.layer, lambda layer_module, h: (layer_module(h, attention_mask, word_size),), hidden_states
             )
-        return word_hidden_states, entity_hidden_states
+        else:
+            for layer_module in self.layer:
+                hidden_states = layer_module(hidden_states, attention_mask, word_size)
+
+        return hidden_states[:, :word_size, :], hidden_states[:, word_size:, :]
@@ -1,22 +1,20 @@
 from typing import Optional
 import torch
+import torch.nn.functional as F
 from torch import nn
 from torch.nn import CrossEntropyLoss
-from transformers.modeling_bert import ACT2FN, BertLayerNorm, BertPreTrainingHeads
+from transformers.modeling_bert import BertPreTrainingHeads
 from transformers.modeling_roberta import RobertaLMHead
 
-from luke.model import LukeModel, LukeConfig
+from luke.model import LukeModel, LukeConfig, get_activation_fn
 
 
 class EntityPredictionHeadTransform(nn.Module):
     def __init__(self, config: LukeConfig):
         super(EntityPredictionHeadTransform, self).__init__()
         self.dense = nn.Linear(config.hidden_size, config.entity_emb_size)
-        if isinstance(config.hidden_act, str):
-            self.transform_act_fn = ACT2FN[config.hidden_act]
-        else:
-            self.transform_act_fn = config.hidden_act
-        self.LayerNorm = BertLayerNorm(config.entity_emb_size, eps=config.layer_norm_eps)
+        self.transform_act_fn = get_activation_fn(config.hidden_act)
+        self.LayerNorm = nn.LayerNorm(config.entity_emb_size, eps=config.layer_norm_eps)
 
     def forward(self, hidden_states: torch.Tensor):
         hidden_states = self.dense(hidden_states)
@@ -35,14 +33,14 @@ class EntityPredictionHead(nn.Module):
 
     def forward(self, hidden_states: torch.Tensor):
         hidden_states = self.transform(hidden_states)
-        hidden_states = self.decoder(hidden_states) + self.bias
+        hidden_states = F.linear(hidden_states, self.decoder.weight, self.bias)
 
         return hidden_states
 
 
 class LukePretrainingModel(LukeModel):
-    def __init__(self, config: LukeConfig):
-        super(LukePretrainingModel, self).__init__(config)
+    def __init__(self, config: LukeConfig, use_amp: bool = False, amp_dtype: torch.dtype = torch.bfloat16):
+        super(LukePretrainingModel, self).__init__(config, use_amp=use_amp, amp_dtype=amp_dtype)
 
         if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
             self.lm_head = RobertaLMHead(config)
@@ -69,61 +67,64 @@ class LukePretrainingModel(LukeModel):
         masked_lm_labels: Optional[torch.LongTensor] = None,
         **kwargs
     ):
-        model_dtype = next(self.parameters()).dtype  # for fp16 compatibility
-
-        output = super(LukePretrainingModel, self).forward(
-            word_ids,
-            word_segment_ids,
-            word_attention_mask,
-            entity_ids,
-            entity_position_ids,
-            entity_segment_ids,
-            entity_attention_mask,
-        )
-        word_sequence_output, entity_sequence_output = output[:2]
-
-        loss_fn = CrossEntropyLoss(ignore_index=-1)
-        ret = dict(loss=word_ids.new_tensor(0.0, dtype=model_dtype))
-
-        if masked_entity_labels is not None:
-            entity_mask = masked_entity_labels != -1
-            if entity_mask.sum() > 0:
-                target_entity_sequence_output = torch.masked_select(entity_sequence_output, entity_mask.unsqueeze(-1))
-                target_entity_sequence_output = target_entity_sequence_output.view(-1, self.config.hidden_size)
-                target_entity_labels = torch.masked_select(masked_entity_labels, entity_mask)
-
-                entity_scores = self.entity_predictions(target_entity_sequence_output)
-                entity_scores = entity_scores.view(-1, self.config.entity_vocab_size)
-
-                ret["masked_entity_loss"] = loss_fn(entity_scores, target_entity_labels)
-                ret["masked_entity_correct"] = (torch.argmax(entity_scores, 1).data == target_entity_labels.data).sum()
-                ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
-                ret["loss"] += ret["masked_entity_loss"]
-            else:
-                ret["masked_entity_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
-                ret["masked_entity_correct"] = word_ids.new_tensor(0, dtype=torch.long)
-                ret["masked_entity_total"] = word_ids.new_tensor(0, dtype=torch.long)
-
-        if masked_lm_labels is not None:
-            masked_lm_mask = masked_lm_labels != -1
-            if masked_lm_mask.sum() > 0:
-                masked_word_sequence_output = torch.masked_select(word_sequence_output, masked_lm_mask.unsqueeze(-1))
-                masked_word_sequence_output = masked_word_sequence_output.view(-1, self.config.hidden_size)
-
-                if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
-                    masked_lm_scores = self.lm_head(masked_word_sequence_output)
+        model_dtype = self.dtype  # for fp16 compatibility
+
+        # the prediction heads and the losses are also run under autocast since the projections onto the word and
+        # entity vocabularies are the largest matrix multiplications in pretraining
+        with self._autocast(word_ids.device.type):
+            output = super(LukePretrainingModel, self).forward(
+                word_ids,
+                word_segment_ids,
+                word_attention_mask,
+                entity_ids,
+                entity_position_ids,
+                entity_segment_ids,
+                entity_attention_mask,
+            )
+            word_sequence_output, entity_sequence_output = output[:2]
+
+            loss_fn = CrossEntropyLoss(ignore_index=-1)
+            ret = dict(loss=word_ids.new_tensor(0.0, dtype=model_dtype))
+
+            if masked_entity_labels is not None:
+                entity_mask = masked_entity_labels != -1
+                if entity_mask.sum() > 0:
+                    target_entity_sequence_output = entity_sequence_output[entity_mask]
+                    target_entity_labels = masked_entity_labels[entity_mask]
+
+                    entity_scores = self.entity_predictions(target_entity_sequence_output)
+                    entity_scores = entity_scores.view(-1, self.config.entity_vocab_size)
+
+                    ret["masked_entity_loss"] = loss_fn(entity_scores, target_entity_labels)
+                    ret["masked_entity_correct"] = (
+                        torch.argmax(entity_scores, 1).data == target_entity_labels.data
+                    ).sum()
+                    ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
+                    ret["loss"] += ret["masked_entity_loss"]
+                else:
+                    ret["masked_entity_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
+                    ret["masked_entity_correct"] = word_ids.new_tensor(0, dtype=torch.long)
+                    ret["masked_entity_total"] = word_ids.new_tensor(0, dtype=torch.long)
+
+            if masked_lm_labels is not None:
+                masked_lm_mask = masked_lm_labels != -1
+                if masked_lm_mask.sum() > 0:
+                    masked_word_sequence_output = word_sequence_output[masked_lm_mask]
+
+                    if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
+                        masked_lm_scores = self.lm_head(masked_word_sequence_output)
+                    else:
+                        masked_lm_scores = self.cls.predictions(masked_word_sequence_output)
+                    masked_lm_scores = masked_lm_scores.view(-1, self.config.vocab_size)
+                    masked_lm_labels = masked_lm_labels[masked_lm_mask]
+
+                    ret["masked_lm_loss"] = loss_fn(masked_lm_scores, masked_lm_labels)
+                    ret["masked_lm_correct"] = (torch.argmax(masked_lm_scores, 1).data == masked_lm_labels.data).sum()
+                    ret["masked_lm_total"] = masked_lm_labels.ne(-1).sum()
+                    ret["loss"] += ret["masked_lm_loss"]
                 else:
-                    masked_lm_scores = self.cls.predictions(masked_word_sequence_output)
-                masked_lm_scores = masked_lm_scores.view(-1, self.config.vocab_size)
-                masked_lm_labels = torch.masked_select(masked_lm_labels, masked_lm_mask)
-
-                ret["masked_lm_loss"] = loss_fn(masked_lm_scores, masked_lm_labels)
-                ret["masked_lm_correct"] = (torch.argmax(masked_lm_scores, 1).data == masked_lm_labels.data).sum()
-                ret["masked_lm_total"] = masked_lm_labels.ne(-1).sum()
-                ret["loss"] += ret["masked_lm_loss"]
-            else:
-                ret["masked_lm_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
-                ret["masked_lm_correct"] = word_ids.new_tensor(0, dtype=torch.long)
-                ret["masked_lm_total"] = word_ids.new_tensor(0, dtype=torch.long)
+                    ret["masked_lm_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
+                    ret["masked_lm_correct"] = word_ids.new_tensor(0, dtype=torch.long)
+                    ret["masked_lm_total"] = word_ids.new_tensor(0, dtype=torch.long)
 
         return ret
@@ -59,6 +59,7 @@ logger = logging.getLogger(__name__)
 @click.option("--mask-words-in-entity-span", is_flag=True)
 @click.option("--fix-bert-weights", is_flag=True)
 @click.option("--grad-avg-on-cpu/--grad-avg-on-gpu", default=False)
+@click.option("--gradient-checkpointing", is_flag=True)
 @click.option("--num-epochs", default=20)
 @click.option("--global-step", default=0)
 @click.option("--fp16", is_flag=True)
@@ -66,6 +67,7 @@ logger = logging.getLogger(__name__)
 @click.option("--fp16-master-weights/--fp16-no-master-weights", default=True)
 @click.option("--fp16-min-loss-scale", default=1)
 @click.option("--fp16-max-loss-scale", default=4)
+@click.option("--bf16", is_flag=True)
 @click.option("--local-rank", "--local_rank", default=-1)
 @click.option("--num-nodes", default=1)
 @click.option("--node-rank", default=0)
@@ -108,6 +110,10 @@ def resume_pretraining(output_dir: str, **kwargs):
         args["unmasked_entity_prob"] = 0.0
         args["random_entity_prob"] = 0.0
         args["mask_words_in_entity_span"] = False
+    if "gradient_checkpointing" not in args:
+        args["gradient_checkpointing"] = False
+    if "bf16" not in args:
+        args["bf16"] = False
 
     step_metadata_file = sorted(
         [f for f in os.listdir(output_dir) if f.startswith("metadata_") and f.endswith(".json")]
@@ -142,6 +148,12 @@ def start_pretraining_worker(local_rank: int, args):
 
 
 def run_pretraining(args):
+    if args.bf16:
+        if args.fp16:
+            raise ValueError("--bf16 cannot be used together with --fp16")
+        if not hasattr(torch, "autocast"):
+            raise RuntimeError("--bf16 requires PyTorch 1.10 or later")
+
     if args.parallel and args.local_rank == -1:
         run_parallel_pretraining(args)
         return
@@ -187,7 +199,9 @@ def run_pretraining(args):
         entity_emb_size=args.entity_emb_size,
         **bert_config.to_dict(),
     )
-    model = LukePretrainingModel(config)
+    model = LukePretrainingModel(config, use_amp=args.bf16)
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
 
     global_step = args.global_step
 
@@ -1,11 +1,22 @@
+import copy
 import functools
+import math
 import operator
 import pytest
 
 import torch
+import torch.nn.functional as F
 from transformers import AutoConfig, AutoModel
 
-from luke.model import EntityEmbeddings, LukeConfig, LukeModel
+from luke.model import (
+    EntityAwareAttention,
+    EntityAwareEncoder,
+    EntityAwareLayer,
+    EntityEmbeddings,
+    LukeConfig,
+    LukeEntityAwareAttentionModel,
+    LukeModel,
+)
 
 BERT_MODEL_NAME = "bert-base-uncased"
 
@@ -26,6 +37,33 @@ def _create_luke_config(bert_config, entity_vocab_size, entity_emb_size):
     )
 
 
+def _create_small_luke_config(**kwargs):
+    config_kwargs = dict(
+        vocab_size=10,
+        entity_vocab_size=5,
+        bert_model_name=BERT_MODEL_NAME,
+        hidden_size=8,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=16,
+    )
+    config_kwargs.update(kwargs)
+    return LukeConfig(**config_kwargs)
+
+
+def _create_luke_inputs(config):
+    word_ids = torch.randint(1, config.vocab_size, (2, 5))
+    return dict(
+        word_ids=word_ids,
+        word_segment_ids=torch.zeros_like(word_ids),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1, 1], [1, 1, 1, 0, 0]]),
+        entity_ids=torch.LongTensor([[1, 2, 0], [3, 4, 1]]),
+        entity_position_ids=torch.LongTensor([[[1, 2], [3, -1], [-1, -1]], [[0, -1], [1, 2], [2, -1]]]),
+        entity_segment_ids=torch.zeros(2, 3, dtype=torch.long),
+        entity_attention_mask=torch.LongTensor([[1, 1, 0], [1, 1, 1]]),
+    )
+
+
 def test_entity_embedding(bert_config):
     config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
     entity_embeddings = EntityEmbeddings(config)
@@ -66,3 +104,210 @@ def test_load_bert_weights(bert_config):
 
     for key, tensor in bert_state_dict.items():
         assert torch.equal(luke_state_dict[key], tensor)
+
+
+def test_luke_model_gradient_checkpointing():
+    config = _create_small_luke_config(num_hidden_layers=5, attention_probs_dropout_prob=0.0, hidden_dropout_prob=0.0)
+    model = LukeModel(config).train()
+    inputs = _create_luke_inputs(config)
+
+    outputs = []
+    for gradient_checkpointing in (False, True):
+        model.encoder.gradient_checkpointing = gradient_checkpointing
+        model.zero_grad()
+        word_output, entity_output, pooled_output = model(**inputs)
+        (word_output.sum() + entity_output.sum() + pooled_output.sum()).backward()
+        grads = [param.grad.clone() for param in model.parameters() if param.grad is not None]
+        outputs.append([word_output, entity_output, pooled_output] + grads)
+
+    assert len(outputs[0]) == len(outputs[1])
+    for tensor, checkpointed_tensor in zip(*outputs):
+        assert torch.allclose(tensor, checkpointed_tensor, atol=1e-6)
+
+    config.output_hidden_states = True
+    with pytest.raises(ValueError):
+        model(**inputs)
+
+
+def test_entity_aware_encoder_gradient_checkpointing():
+    config = _create_small_luke_config(num_hidden_layers=5, attention_probs_dropout_prob=0.0, hidden_dropout_prob=0.0)
+    encoder = EntityAwareEncoder(config).train()
+    word_hidden_states = torch.randn(2, 5, config.hidden_size, requires_grad=True)
+    entity_hidden_states = torch.randn(2, 3, config.hidden_size, requires_grad=True)
+    attention_mask = torch.zeros(2, 1, 1, 8)
+
+    outputs = []
+    for gradient_checkpointing in (False, True):
+        encoder.gradient_checkpointing = gradient_checkpointing
+        word_output, entity_output = encoder(word_hidden_states, entity_hidden_states, attention_mask)
+        assert word_output.size() == word_hidden_states.size()
+        assert entity_output.size() == entity_hidden_states.size()
+        word_hidden_states.grad = None
+        entity_hidden_states.grad = None
+        (word_output.sum() + entity_output.sum()).backward()
+        outputs.append((word_output, entity_output, word_hidden_states.grad, entity_hidden_states.grad))
+
+    for tensor, checkpointed_tensor in zip(*outputs):
+        assert torch.allclose(tensor, checkpointed_tensor, atol=1e-6)
+
+
+def test_entity_aware_attention_model_load_state_dict():
+    config = _create_small_luke_config()
+    luke_state_dict = LukeModel(config).state_dict()
+
+    model = LukeEntityAwareAttentionModel(config)
+    model.load_state_dict(luke_state_dict)
+    state_dict = model.state_dict()
+
+    for num in range(config.num_hidden_layers):
+        prefix = f"encoder.layer.{num}.attention.self."
+        for attr_name in ("weight", "bias"):
+            query = luke_state_dict[f"{prefix}query.{attr_name}"]
+            key = luke_state_dict[f"{prefix}key.{attr_name}"]
+            value = luke_state_dict[f"{prefix}value.{attr_name}"]
+            assert torch.equal(state_dict[f"{prefix}word_query.{attr_name}"], torch.cat([query, query]))
+            assert torch.equal(state_dict[f"{prefix}entity_query.{attr_name}"], torch.cat([query, query]))
+            assert torch.equal(state_dict[f"{prefix}key_value.{attr_name}"], torch.cat([key, value]))
+
+
+@pytest.mark.parametrize("use_sdpa", [True, False])
+def test_entity_aware_attention(use_sdpa, monkeypatch):
+    if not use_sdpa:
+        monkeypatch.delattr(F, "scaled_dot_product_attention", raising=False)
+
+    config = _create_small_luke_config(attention_probs_dropout_prob=0.0, hidden_dropout_prob=0.0)
+    attention = EntityAwareAttention(config).eval()
+    self_attention = attention.self
+    self_attention.max_chunk_size_mb = 0  # process a single query row at a time in the fallback path
+
+    word_size = 5
+    hidden_states = torch.randn(2, word_size + 3, config.hidden_size)
+    attention_mask = torch.zeros(2, 1, 1, word_size + 3)
+    attention_mask[0, :, :, -1] = torch.finfo(attention_mask.dtype).min
+
+    def split_heads(x):
+        return x.view(x.size(0), x.size(1), config.num_attention_heads, -1).transpose(1, 2)
+
+    word_hidden_states = hidden_states[:, :word_size]
+    entity_hidden_states = hidden_states[:, word_size:]
+    w2w_query, w2e_query = map(split_heads, self_attention.word_query(word_hidden_states).chunk(2, dim=-1))
+    e2w_query, e2e_query = map(split_heads, self_attention.entity_query(entity_hidden_states).chunk(2, dim=-1))
+    key, value = map(split_heads, self_attention.key_value(hidden_states).chunk(2, dim=-1))
+    word_key = key[:, :, :word_size]
+    entity_key = key[:, :, word_size:]
+
+    word_scores = torch.cat([w2w_query @ word_key.transpose(-1, -2), w2e_query @ entity_key.transpose(-1, -2)], dim=3)
+    entity_scores = torch.cat([e2w_query @ word_key.transpose(-1, -2), e2e_query @ entity_key.transpose(-1, -2)], dim=3)
+    scores = torch.cat([word_scores, entity_scores], dim=2) / math.sqrt(value.size(-1)) + attention_mask
+    context = (F.softmax(scores, dim=-1) @ value).transpose(1, 2).reshape(hidden_states.size())
+    expected = attention.output(context, hidden_states)
+
+    with torch.no_grad():
+        output = attention(hidden_states, attention_mask, word_size)
+
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="torch.autocast is not available")
+@pytest.mark.parametrize("model_class", [LukeModel, LukeEntityAwareAttentionModel])
+def test_luke_model_autocast(model_class):
+    config = _create_small_luke_config()
+    model = model_class(config, use_amp=True, amp_dtype=torch.bfloat16).eval()
+    inputs = _create_luke_inputs(config)
+
+    with torch.no_grad():
+        amp_outputs = model(**inputs)
+        model.use_amp = False
+        outputs = model(**inputs)
+
+    for amp_output, output in zip(amp_outputs, outputs):
+        assert amp_output.size() == output.size()
+        assert torch.allclose(amp_output.float(), output, atol=1e-1)
+
+
+@pytest.mark.skipif(not hasattr(torch.nn.Module, "compile"), reason="nn.Module.compile is not available")
+def test_luke_model_compile_layers():
+    config = _create_small_luke_config()
+    model = LukeModel(config).eval()
+    inputs = _create_luke_inputs(config)
+
+    with torch.no_grad():
+        outputs = model(**inputs)
+        model.compile_layers()
+        compiled_outputs = model(**inputs)
+
+    for output, compiled_output in zip(outputs, compiled_outputs):
+        assert torch.allclose(output, compiled_output, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_luke_model_compute_embeddings_on_side_stream():
+    config = _create_small_luke_config(hidden_dropout_prob=0.0)
+    model = LukeModel(config).train()
+    inputs = _create_luke_inputs(config)
+    arg_names = ("word_ids", "word_segment_ids", "entity_ids", "entity_position_ids", "entity_segment_ids")
+    embedding_args = [inputs[name] for name in arg_names]
+
+    results = []
+    for device in (torch.device("cpu"), torch.device("cuda")):
+        model.to(device)
+        model.zero_grad()
+        word_embeddings, entity_embeddings = model._compute_embeddings(*[arg.to(device) for arg in embedding_args])
+        (word_embeddings.sum() + entity_embeddings.sum()).backward()
+        grads = [param.grad.cpu() for param in model.parameters() if param.grad is not None]
+        results.append([word_embeddings.detach().cpu(), entity_embeddings.detach().cpu()] + grads)
+
+    assert len(results[0]) == len(results[1])
+    for cpu_tensor, cuda_tensor in zip(*results):
+        assert torch.allclose(cpu_tensor, cuda_tensor, atol=1e-5)
+
+    # the model can still be copied after the side stream is created
+    copy.deepcopy(model)
+
+
+def test_entity_aware_layer_joint_feed_forward():
+    config = _create_small_luke_config(attention_probs_dropout_prob=0.0, hidden_dropout_prob=0.0)
+    layer = EntityAwareLayer(config).eval()
+
+    word_size = 5
+    hidden_states = torch.randn(2, word_size + 3, config.hidden_size)
+    attention_mask = torch.zeros(2, 1, 1, word_size + 3)
+
+    with torch.no_grad():
+        output = layer(hidden_states, attention_mask, word_size)
+
+        attention_output = layer.attention(hidden_states, attention_mask, word_size)
+        word_attention_output = attention_output[:, :word_size]
+        entity_attention_output = attention_output[:, word_size:]
+        word_output = layer.output(layer.intermediate(word_attention_output), word_attention_output)
+        entity_output = layer.output(layer.intermediate(entity_attention_output), entity_attention_output)
+
+    assert torch.allclose(output[:, :word_size], word_output, atol=1e-6)
+    assert torch.allclose(output[:, word_size:], entity_output, atol=1e-6)
+
+
+@pytest.mark.parametrize("use_sdpa", [True, False])
+def test_entity_aware_attention_without_entities(use_sdpa, monkeypatch):
+    if not use_sdpa:
+        monkeypatch.delattr(F, "scaled_dot_product_attention", raising=False)
+
+    config = _create_small_luke_config()
+    attention = EntityAwareAttention(config).eval()
+    hidden_states = torch.randn(2, 5, config.hidden_size)
+    attention_mask = torch.zeros(2, 1, 1, 5)
+
+    with torch.no_grad():
+        output = attention(hidden_states, attention_mask, 5)
+
+    assert output.size() == hidden_states.size()
+
+
+def test_entity_embedding_without_entities():
+    config = _create_small_luke_config()
+    entity_embeddings = EntityEmbeddings(config)
+    entity_ids = torch.zeros(2, 0, dtype=torch.long)
+    position_ids = torch.zeros(2, 0, 3, dtype=torch.long)
+    token_type_ids = torch.zeros(2, 0, dtype=torch.long)
+
+    emb = entity_embeddings(entity_ids, position_ids, token_type_ids)
+    assert emb.size() == (2, 0, config.hidden_size)